@@ -4,15 +4,41 @@
    friendly (imho) to use than unittest, and to not depend on the docstrings
    for the tests (like doctest)."""
 
-import datetime
+import contextlib
 import functools
-import inspect
-import io
 import os
 import sys
-import textwrap
-import tokenize
-import traceback
+import threading
+import time
+
+# inspect, io, tokenize and traceback are deliberately not
+# imported here: they're only needed to report failures, and a suite
+# where every test passes shouldn't pay for them at import time
+# (tokenize especially is slow to import); same goes for
+# concurrent.futures which drags several of them in transitively
+
+# marker for names absent from the frame namespace, as None is a
+# perfectly valid value for a variable
+_MISS = object()
+
+# cache the expansion functions compiled for the error lines, keyed
+# by (code, lineno), so that a test failing again and again doesn't
+# pay for inspect.getsourcelines (which reads the file), tokenize (a
+# full lexer pass) nor a Python-level token walk more than once
+_EXPAND_CACHE = {}
+
+def _substitute(namespace, name):
+    """Return the representation of the value bound to name in
+       namespace, or name itself if it's unknown or callable."""
+
+    v = namespace.get(name, _MISS)
+    if v is _MISS or callable(v):
+        return name
+
+    # most values (ints, strings, ...) have no __name__, and raising
+    # AttributeError for each of them is costly, so probe with getattr
+    n = getattr(v, '__name__', None)
+    return repr(v) if n is None else n
 
 def get_meaningful_expression(tb):
     """Try to replace the variable names by their values to
@@ -22,80 +48,91 @@ def get_meaningful_expression(tb):
 
        Return the error line and the expanded line ("dedented")"""
 
+    import inspect
+    import io
+    import tokenize
+
     # we only want the tb were the exception was raised
     while tb.tb_next:
         tb = tb.tb_next
 
     # get frame and dictionnary of locals(), globals() when
-    # the exception was raised
+    # the exception was raised; locals shadow globals, so merge the
+    # two once and each substituted name costs a single lookup
     frame = tb.tb_frame
-    local_vars, global_vars = frame.f_locals, frame.f_globals
+    namespace = {**frame.f_globals, **frame.f_locals}
 
     # err_lineno is the line number of where the error occured
-    # lineno is the line number of the first line of source
     err_lineno = tb.tb_lineno
-    source, lineno = inspect.getsourcelines(tb)
+    key = frame.f_code, err_lineno
 
-    # just remove the indentation
-    err_line = textwrap.dedent(source[err_lineno - lineno])
-    backup = err_line
+    try:
+        backup, expand = _EXPAND_CACHE[key]
+    except KeyError:
+        # lineno is the line number of the first line of source
+        source, lineno = inspect.getsourcelines(tb)
+
+        # just remove the indentation (no need for textwrap.dedent
+        # and its regexes on a single line)
+        err_line = source[err_lineno - lineno].lstrip()
+        backup = err_line
+
+        # build the pieces of a function specialized for this very
+        # line: everything but the NAME tokens is hardcoded as string
+        # constants, so reruns skip straight to the substitutions
+        args = []
+        literal = ''
+        readline = io.StringIO(err_line).readline
+        prev_ecol = 0
+
+        # generate_tokens works on str directly, so no need to encode
+        # the line nor to skip an ENCODING token
+        for tok_type, tok_str, (_, scol), (_, ecol), _ in \
+                tokenize.generate_tokens(readline):
+            # restore whitespaces as tokenize doesn't yield them,
+            # using the column offsets it gives us for free
+            literal += ' ' * (scol - prev_ecol)
+            prev_ecol = ecol
 
-    expanded = ''
-    readline = io.BytesIO(err_line.encode('UTF-8')).readline
+            if tok_type == tokenize.NAME:
+                if literal:
+                    args.append(repr(literal))
+                    literal = ''
+                args.append('_substitute(ns, %r)' % tok_str)
+            else:
+                literal += tok_str
 
-    for tok_type, tok_str, *_ in tokenize.tokenize(readline):
-        # the first token is utf-8 and we don't want it
-        if tok_type != tokenize.ENCODING:
-            # restore whitespaces as tokenize doesn't yield them
-            i = err_line.index(tok_str)
-            expanded += ' ' * i
+        if literal:
+            args.append(repr(literal))
 
-            # consume the error line
-            err_line = err_line[i+len(tok_str):]
+        src = 'def _expand(ns):\n    return %s\n'\
+                % (' + '.join(args) if args else "''")
+        env = {'_substitute': _substitute}
+        exec(compile(src, '<swallow expansion>', 'exec'), env)
+        expand = env['_expand']
 
-            if tok_type == tokenize.NAME:
-                # if tok_str is in the locals, globals we add
-                # its representation to expanded, otherwise
-                # we just add tok_str
-                if tok_str in local_vars:
-                    v = local_vars[tok_str]
-                    if callable(v):
-                        expanded += tok_str
-                    else:
-                        try:
-                            expanded += v.__name__
-                        except AttributeError:
-                            expanded += repr(v)
-                elif tok_str in global_vars:
-                    v = global_vars[tok_str]
-                    if callable(v):
-                        expanded += tok_str
-                    else:
-                        try:
-                            expanded += v.__name__
-                        except AttributeError:
-                            expanded += repr(v)
-                else:
-                    expanded += tok_str
-            else:
-                expanded += tok_str
+        _EXPAND_CACHE[key] = backup, expand
 
-    return backup, expanded
+    return backup, expand(namespace)
 
 def print_exception(type, value, tb, expand_errors=True):
     """Print the exception represented by (type, value, tb), and if
        expand_errors is True try to replace variables names by their
-       values."""
+       values (only done when stderr is a terminal, nobody reads the
+       expanded line in a log file)."""
+
+    import traceback
 
     # remove the first tb, because that's just us catching the user exception
     tb = tb.tb_next
     traceback.print_exception(type, value, tb)
 
-    if expand_errors:
+    if expand_errors and sys.stderr.isatty():
         o, e = get_meaningful_expression(tb)
         if o != e:
             print(' ' * 4, e, file=sys.stderr, sep='')
 
+@functools.lru_cache(maxsize=None)
 def takes_no_positional_arguments(fn):
     """Return True if fn requires not positional arguments,
        False otherwise.
@@ -104,13 +141,14 @@ def takes_no_positional_arguments(fn):
        the print function for instance, as it's built-in in
        C it won't work)."""
 
+    # everything we need lives on the code object, no need for the
+    # (slow, and gone in recent Pythons) inspect.getargspec
     try:
-        pos, _, _, default = inspect.getargspec(fn)
-    except TypeError:
+        code = fn.__code__
+    except AttributeError:
         return None
 
-    default = default or ()
-    return len(default) - len(pos) == 0
+    return code.co_argcount == len(fn.__defaults__ or ())
 
 def timer(fn):
     """This decorator compute the time needed to run a callable
@@ -118,10 +156,9 @@ def timer(fn):
 
     @functools.wraps(fn)
     def wrapper(*args, **kwds):
-        begin = datetime.datetime.now()
+        begin = time.perf_counter()
         r = fn(*args, **kwds)
-        end = datetime.datetime.now()
-        print('Executed in %.2f seconds.' % (end - begin).total_seconds())
+        print('Executed in %.2f seconds.' % (time.perf_counter() - begin))
         return r
 
     return wrapper
@@ -169,11 +206,32 @@ def singletest(expected=None, setup=None, teardown=None, run_if=True):
                 raise ValueError('%s isn\'t callable without positional'
                         ' arguments.' % f)
 
-        @functools.wraps(fn)
-        def wrapper(*args, **kwds):
-            return fn(*args, **kwds)
-
-        def run(no_output=True):
+        # raise an exception if expected isn't an exception type, as
+        # run() relies on the interpreter matching it in an except
+        # clause
+        if expected is not None and not (isinstance(expected, type)
+                and issubclass(expected, BaseException)):
+            raise ValueError('%s isn\'t an exception type.' % (expected,))
+
+        # build the "expected but not raised" message once, at
+        # decoration time, rather than on every run
+        if expected:
+            name = getattr(expected, '__name__', None)
+            if name is None:
+                name = str(expected)
+
+            no_exc_reason = 'No exception was raised'\
+                    ' (expected %s).' % name
+            expected_excs = (expected,)
+        else:
+            no_exc_reason = None
+            expected_excs = ()
+
+        # setup & co are bound as default arguments so the body works
+        # on LOAD_FAST instead of LOAD_DEREF
+        def run(no_output=True, setup=setup, teardown=teardown,
+                expected=expected, expected_excs=expected_excs,
+                no_exc_reason=no_exc_reason):
             """See singletest for doc."""
 
             if not run_if:
@@ -183,10 +241,12 @@ def singletest(expected=None, setup=None, teardown=None, run_if=True):
                 try:
                     with stdout_to_devnull(no_output):
                         setup()
-                except Exception:
+                except Exception as e:
                     # we exit the function now because setup failed
                     # so we don't want to run fn(), or teardown()
-                    return False, None, sys.exc_info()
+                    # (the caught exception carries everything
+                    # sys.exc_info() would have given us)
+                    return False, None, (type(e), e, e.__traceback__)
 
             state, reason, exc = True, None, None
 
@@ -195,16 +255,14 @@ def singletest(expected=None, setup=None, teardown=None, run_if=True):
                     fn()
 
                 if expected:
-                    try:
-                        name = expected.__name__
-                    except AttributeError:
-                        name = str(expected)
-
-                    state, reason = False, 'No exception was raised'\
-                            ' (expected %s).' % name
+                    state, reason = False, no_exc_reason
+            except expected_excs:
+                # the exception matching is done by the interpreter
+                # itself, no need to compare types by hand (note that
+                # subclasses of expected now match too)
+                pass
             except Exception as e:
-                if type(e) != expected:
-                    state, exc = False, sys.exc_info()
+                state, exc = False, (type(e), e, e.__traceback__)
 
             if teardown:
                 try:
@@ -213,44 +271,99 @@ def singletest(expected=None, setup=None, teardown=None, run_if=True):
                 except Exception as e:
                     # set exc only if it's the first problem so far
                     if reason is None and exc is None:
-                        state, exc = False, sys.exc_info()
+                        state, exc = False, (type(e), e, e.__traceback__)
 
             return state, reason, exc
 
-        wrapper.run = run
-        return wrapper
+        # no need to wrap fn in a function which only forwards its
+        # arguments: just stick run on it (fall back to a wrapper for
+        # the odd callables which refuse new attributes)
+        try:
+            fn.run = run
+        except (AttributeError, TypeError):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwds):
+                return fn(*args, **kwds)
+
+            wrapper.run = run
+            return wrapper
+
+        return fn
     return decorating_function
 
-class stdout_to_devnull:
-    """This class it aimed to be used with the with
-       keyword to throw the stdout output of the with
-       block to os.devnull."""
+# opened once and never closed: every test (setup, fn, teardown) going
+# through stdout_to_devnull reuses it instead of paying for an open
+# syscall each time
+_DEVNULL = open(os.devnull, 'w')
+
+class _ThreadLocalStdout:
+    """Stand-in for sys.stdout which forwards everything to a
+       per-thread target (defaulting to the stdout it replaced), so
+       each thread may redirect its own output without racing with
+       the others."""
+
+    def __init__(self, default):
+        self.default = default
+        self._local = threading.local()
+
+    def current(self):
+        """Return the target this thread's output goes to."""
 
-    def __init__(self, hide=True):
-        """If hide is False this class will have no effect,
-           otherwise just hide shadow sys.stdout by os.devnull."""
+        return getattr(self._local, 'target', self.default)
 
-        self.stdout = None
-        self.hide = hide
+    def redirect(self, target):
+        """Send this thread's output to target."""
+
+        self._local.target = target
+
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
+
+class _HideStdout:
+    """Context manager which unconditionally shadows sys.stdout
+       by os.devnull, use stdout_to_devnull instead."""
 
     def __enter__(self):
-        """Map sys.stdout to os.devnull if needed, and backup
-           sys.stdout (and return it)."""
+        """Map sys.stdout to os.devnull, and backup sys.stdout
+           (and return it)."""
 
-        if self.hide:
-            self.stdout = sys.stdout
-            sys.stdout = open(os.devnull, 'w')
-            return self.stdout
+        stdout = sys.stdout
 
-        return sys.stdout
+        # when a _ThreadLocalStdout is installed (see Swallow.run)
+        # redirect only the current thread, as swapping the global
+        # sys.stdout from several threads at once isn't safe
+        if isinstance(stdout, _ThreadLocalStdout):
+            self.proxy = stdout
+            self.stdout = stdout.current()
+            stdout.redirect(_DEVNULL)
+        else:
+            self.proxy = None
+            self.stdout = stdout
+            sys.stdout = _DEVNULL
+
+        return self.stdout
 
     def __exit__(self, *_):
-        """Restore sys.stdout if needed."""
+        """Restore sys.stdout."""
 
-        if self.hide:
-            sys.stdout.close()
+        if self.proxy is not None:
+            self.proxy.redirect(self.stdout)
+        else:
             sys.stdout = self.stdout
 
+def stdout_to_devnull(hide=True):
+    """Return a context manager throwing the stdout output of the
+       with block to os.devnull, or a do-nothing one if hide is
+       False."""
+
+    if hide:
+        return _HideStdout()
+
+    return contextlib.nullcontext(sys.stdout)
+
+
+# tell a bare @t apart from @t(...) without probing the argument
+_SENTINEL = object()
 
 class Swallow:
     """An instance of this class may be used to collect testcase,
@@ -261,10 +374,42 @@ class Swallow:
            (resp. after) the test function."""
 
         self.tests = []
+        # names and run functions are also kept in parallel lists so
+        # that run() below iterates over plain locals instead of
+        # resolving t.__name__/t.run per test
+        self._names = []
+        self._runs = []
         self.setup = setup
         self.teardown = teardown
 
-    def __call__(self, run_if=True):
+    def _add(self, t):
+        """Record the decorated test t in the suite."""
+
+        self.tests.append(t)
+        self._names.append(t.__name__)
+        self._runs.append(t.run)
+
+    def register(self, fn):
+        """Add fn to the list of testscases, and return the decorated
+           version of fn."""
+
+        t = singletest(setup=self.setup, teardown=self.teardown)(fn)
+        self._add(t)
+        return t
+
+    def register_if(self, run_if):
+        """Return a decorator which add the underlying function to the
+           list of testscases, to be run only if run_if is fulfilled."""
+
+        def wrapper(fn):
+            t = singletest(setup=self.setup, teardown=self.teardown,
+                    run_if=run_if)(fn)
+            self._add(t)
+            return t
+
+        return wrapper
+
+    def __call__(self, run_if=_SENTINEL):
         """This decorator may be used in two ways:
 
            t = Swallow()
@@ -279,22 +424,20 @@ class Swallow:
 
            In the first case it just add a to the list of testscases,
            in the second case it still add b to the list of testscases
-           but it will be run only if the condition is fulfilled."""
+           but it will be run only if the condition is fulfilled.
 
+           Both cases are also available explicitly as register and
+           register_if."""
 
-        # dirty hack to see in which case we are
-        if callable(run_if):
-            fn = run_if
-            t = singletest(setup=self.setup, teardown=self.teardown)(fn)
-            self.tests.append(t)
-            return t
+        # @t() without condition: always run
+        if run_if is _SENTINEL:
+            return self.register_if(True)
 
-        def wrapper(fn):
-            t = singletest(setup=self.setup, teardown=self.teardown, run_if=run_if)(fn)
-            self.tests.append(t)
-            return t
+        # @t directly on the function
+        if callable(run_if):
+            return self.register(run_if)
 
-        return wrapper
+        return self.register_if(run_if)
 
     def expect(self, expected, run_if=True):
         """This decorator add the underlying function to the list of testscases
@@ -306,7 +449,7 @@ class Swallow:
 
         def wrapper(fn):
             t = singletest(expected, self.setup, self.teardown, run_if=run_if)(fn)
-            self.tests.append(t)
+            self._add(t)
             return t
 
         return wrapper
@@ -315,8 +458,8 @@ class Swallow:
         """Just allow someone to iterate over the result of the testscases
            instead of using run."""
 
-        for t in self.tests:
-            yield t.run(False)
+        for run in self._runs:
+            yield run(False)
 
     @timer
     def run(self, no_output=True, expand_errors=True):
@@ -331,32 +474,58 @@ class Swallow:
            number of successful tests, not runned test (because of the
            run_if parameter) and the number of failed tests."""
 
+        import concurrent.futures
+
         passed = 0
         not_run = 0
         failed = 0
 
-        for t in self.tests:
-            print('Testing %s: ' % t.__name__, end='')
+        # bind these as locals once, the repeated LOAD_GLOBAL/LOAD_ATTR
+        # in the loop below add up on big suites
+        _print = print
+        _stderr = sys.stderr
+        _print_exception = print_exception
+
+        # the tests are independent so run them concurrently; a
+        # per-thread dispatching proxy shadows sys.stdout for the
+        # duration of the pool so that the workers (whose tests may
+        # well redirect their own output, e.g. through nested run()
+        # calls) don't stamp on each other's redirections, and the
+        # results are reported serially afterwards
+        with stdout_to_devnull(no_output):
+            proxy = _ThreadLocalStdout(sys.stdout)
+            sys.stdout = proxy
 
-            state, reason, exc = t.run(no_output)
+            try:
+                with concurrent.futures.ThreadPoolExecutor(
+                        max_workers=os.cpu_count()) as executor:
+                    results = list(executor.map(lambda run: run(False),
+                            self._runs))
+            finally:
+                sys.stdout = proxy.default
+
+        # emit the label and the status as a single write per test,
+        # rather than two prints (i.e. two syscalls)
+        _write = sys.stdout.write
+
+        for name, (state, reason, exc) in zip(self._names, results):
             if exc is not None:
                 type, value, tb = exc
 
             if state:
                 passed += 1
-                print('PASS')
+                _write('Testing %s: PASS\n' % name)
             elif state is None:
                 not_run += 1
-                print('NOT RUN')
+                _write('Testing %s: NOT RUN\n' % name)
             else:
                 failed += 1
-                print('FAIL')
+                _write('Testing %s: FAIL\n' % name)
                 if reason:
-                    print(reason, file=sys.stderr)
+                    _print(reason, file=_stderr)
                 else:
-                    print_exception(type, value, tb, expand_errors)
+                    _print_exception(type, value, tb, expand_errors)
 
-        print()
-        print('%d tests, %d PASS, %d NOT RUN, %d FAIL' % (len(self.tests), passed, not_run, failed,))
+        _write('\n%d tests, %d PASS, %d NOT RUN, %d FAIL\n' % (len(self.tests), passed, not_run, failed,))
         return (passed, not_run, failed)
 
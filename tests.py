@@ -137,8 +137,13 @@ def swallow_class():
     def g():
         pass
 
+    # subclasses of the expected exception match too
+    @t.expect(ArithmeticError)
+    def h():
+        1 // 0
+
     l = [x for x, _, _ in t]
-    assert l == [True, None, True, True, False, False, False]
+    assert l == [True, None, True, True, False, False, False, True]
 
 @test.expect(ValueError)
 def uncorrect_fn():
@@ -158,6 +163,18 @@ def uncorrect_fn3():
     def a():
         pass
 
+@test.expect(ValueError)
+def uncorrect_fn4():
+    @swallow.singletest(42)
+    def a():
+        pass
+
+@test.expect(ValueError)
+def uncorrect_fn5():
+    @swallow.singletest(ValueError('not a type'))
+    def a():
+        pass
+
 if __name__ == '__main__':
     test.run()
 